@@ -1,3 +1,9 @@
+# Patch sockets/threads before anything else imports them so the blocking
+# requests/pymongo calls yield under gevent workers
+import gevent
+from gevent import monkey
+monkey.patch_all()
+
 import logging
 from logging.config import dictConfig
 
@@ -24,23 +30,40 @@ dictConfig({
     }
 })
 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, make_response, Response, stream_with_context
 from flask_pymongo import PyMongo
 import pymongo
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import DuplicateKeyError
 from flask import session, redirect, url_for, flash
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from flask_cors import CORS, cross_origin
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 from datetime import datetime, timezone, timedelta
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
 import random
 import logging
-import traceback
+import hashlib
+import re
+import queue
+from collections import defaultdict
+from statistics import fmean
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask_wtf.csrf import CSRFProtect
+from flask_caching import Cache
 from bson import Decimal128
 from openai import OpenAI
+import httpx
+import orjson
+from pydantic import BaseModel, StrictInt, StrictStr, ValidationError
+from flask.json.provider import DefaultJSONProvider
+from markupsafe import escape
 import requests
 from flask import session
 from bson import ObjectId
@@ -57,7 +80,29 @@ for logger_name in loggers:
 
 load_dotenv()
 
+class OrjsonProvider(DefaultJSONProvider):
+    # orjson encodes the large itinerary payloads much faster than stdlib json;
+    # BSON types are converted in its default hook, anything else falls back
+    # to Flask's default handling
+    @staticmethod
+    def default(o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, Decimal128):
+            return float(o.to_decimal())
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        # PyMongo hands back naive datetimes that are UTC
+        return orjson.dumps(
+            obj, default=self.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
+app.json = OrjsonProvider(app)
 
 CORS(app, 
     supports_credentials=True,
@@ -77,22 +122,36 @@ app.config.update({
     'DEBUG': False,  # Force-disable Flask debug mode
     'SESSION_COOKIE_SAMESITE': 'Lax',
     'SESSION_COOKIE_SECURE': False,
-    'SESSION_COOKIE_DOMAIN': None  # Explicitly set to None for localhost
+    'SESSION_COOKIE_DOMAIN': None,  # Explicitly set to None for localhost
+    # Redis shares cached API responses across workers when REDIS_URL is set
+    'CACHE_TYPE': os.getenv('CACHE_TYPE', 'RedisCache' if os.getenv('REDIS_URL') else 'SimpleCache'),
+    'CACHE_REDIS_URL': os.getenv('REDIS_URL'),
+    'CACHE_KEY_PREFIX': 'tour_',
+    'CACHE_DEFAULT_TIMEOUT': 3600
 })
 
 csrf = CSRFProtect(app)
+cache = Cache(app)
 
 # Configure PyMongo with production settings
 mongo = PyMongo(app, 
-    connectTimeoutMS=30000,
-    socketTimeoutMS=30000,
-    serverSelectionTimeoutMS=30000,
+    # Fail fast when the cluster is unreachable instead of parking workers
+    connectTimeoutMS=5000,
+    socketTimeoutMS=10000,
+    serverSelectionTimeoutMS=5000,
+    maxPoolSize=50,
+    minPoolSize=5,  # Kept open so the first requests skip TCP+TLS+auth setup
+    maxIdleTimeMS=60000,
     tls=True,
-    tlsAllowInvalidCertificates=True,
+    retryWrites=True,
+    compressors='snappy,zlib',  # Itineraries are text-heavy; zlib if snappy is missing
     connect=False  # Defer connection until first use
 )
 users_collection = mongo.db.users
 itinerary_collection = mongo.db.itineraries
+# Generated itineraries can be rebuilt, so saving them only waits for the
+# primary's in-memory ack rather than journal/replica confirmation
+itinerary_writes = itinerary_collection.with_options(write_concern=WriteConcern(w=1, j=False))
 
 # API Keys Configuration
 API_KEYS = {
@@ -101,48 +160,96 @@ API_KEYS = {
     "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY"),
     "UNSPLASH_API_KEY": os.getenv("UNSPLASH_API_KEY")
 }
-client = OpenAI(api_key=API_KEYS["OPENAI_API_KEY"])
+# External endpoints and request constants, built once at import
+WIKIPEDIA_URL = "https://en.wikipedia.org/w/api.php"
+UNSPLASH_URL = "https://api.unsplash.com/search/photos"
+UNSPLASH_HEADERS = {"Authorization": f"Client-ID {API_KEYS['UNSPLASH_API_KEY']}"}
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
+PLACES_URL = "https://maps.googleapis.com/maps/api/place/textsearch/json"
+WEATHER_URL = "https://api.openweathermap.org/data/2.5/forecast"
+VALID_ACTIVITIES = frozenset({'city', 'beaches', 'hiking', 'food'})
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+# Bound the chat call so a stalled completion can't hold a worker
+# indefinitely, but leave a 1500-token completion from a slower model room
+# to finish. No retries: a timed-out completion is already billed, and the
+# SDK would retry read timeouts too.
+client = OpenAI(
+    api_key=API_KEYS["OPENAI_API_KEY"],
+    timeout=httpx.Timeout(float(os.getenv("OPENAI_TIMEOUT", 90)), connect=5.0),
+    max_retries=0
+)
+
+# Must match gunicorn's --worker-connections: under gevent the executor's
+# workers are greenlets shared by every request on the worker, so a smaller
+# pool would queue concurrent /generate calls behind each other. Workers and
+# connections are only created on demand.
+WORKER_CONNECTIONS = int(os.getenv('WORKER_CONNECTIONS', 1000))
+
+# Shared pool for overlapping independent outbound API calls
+EXECUTOR = ThreadPoolExecutor(max_workers=WORKER_CONNECTIONS)
+
+# Keep-alive connection pool shared by all outbound API calls,
+# with a short retry on transient upstream failures
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=WORKER_CONNECTIONS,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
 
 def check_mongo_connection():
     try:
         # Force connection initialization
         mongo.cx.server_info()
+        # Open several pooled sockets up front by pinging concurrently
+        list(EXECUTOR.map(lambda _: mongo.cx.admin.command('ping'), range(5)))
         logging.getLogger(__name__).info("MongoDB connection established")
     except Exception as e:
-        logging.getLogger(__name__).critical(f"MongoDB connection failed: {str(e)}")
+        logging.getLogger(__name__).critical("MongoDB connection failed: %s", e)
         raise
 
 def create_indexes():
-    itinerary_collection.create_index([("destination", pymongo.TEXT)])
-    users_collection.create_index([("email", pymongo.ASCENDING)], unique=True)
-    # Add user_id index separately
-    itinerary_collection.create_index([("user_id", pymongo.ASCENDING)])
+    try:
+        # create_index is a no-op when the index already exists, so every
+        # worker can run this; default names match indexes already deployed
+        itinerary_collection.create_index([("destination", pymongo.TEXT)])
+        users_collection.create_index([("email", pymongo.ASCENDING)], unique=True)
+        # Serves both the per-user filter and the profile page's newest-first sort
+        itinerary_collection.create_index([("user_id", pymongo.ASCENDING), ("created_at", pymongo.DESCENDING)])
+        # At most one current plan per trip, so two concurrent submits of the
+        # same trip can't both insert; documents from before destination_key
+        # existed are left out
+        itinerary_collection.create_index(
+            [("user_id", pymongo.ASCENDING), ("destination_key", pymongo.ASCENDING),
+             ("travel_date", pymongo.ASCENDING)],
+            unique=True,
+            partialFilterExpression={"is_current": True, "destination_key": {"$exists": True}}
+        )
+    except Exception as e:
+        logging.getLogger(__name__).error("Index creation failed: %s", e)
 
 check_mongo_connection()
-create_indexes()
-
-def convert_bson_types(obj):
-    if isinstance(obj, ObjectId):
-        return str(obj)
-    if isinstance(obj, Decimal128):
-        return float(obj.to_decimal())
-    if isinstance(obj, dict):
-        converted = {}
-        for k, v in obj.items():
-            if k in ['lat', 'lng'] and isinstance(v, Decimal128):
-                converted[k] = float(v.to_decimal())
-            else:
-                converted[k] = convert_bson_types(v)
-        return converted
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    if isinstance(obj, list):
-        return [convert_bson_types(v) for v in obj]
-    if isinstance(obj, dict):
-        return {k: convert_bson_types(v) for k, v in obj.items()}
-    return obj
-
-def get_city_info(destination):
+# Don't hold up worker boot on index round trips
+EXECUTOR.submit(create_indexes)
+
+def normalize_destination(destination):
+    # "Lahore" and " lahore " should share one cache entry
+    return ' '.join(destination.split()).lower()
+
+CITY_DESCRIPTION_UNAVAILABLE = 'Information unavailable'
+
+# Wikipedia and Unsplash are independent, so they are fetched (and cached)
+# separately and the caller submits both to the executor at once.
+# Keyed on the normalized name only; Wikipedia titles are case-sensitive,
+# so the lookup itself still uses the name as entered
+@cache.memoize(timeout=86400,
+               response_filter=lambda description: description != CITY_DESCRIPTION_UNAVAILABLE,
+               args_to_ignore=['destination'])
+def fetch_city_description(cache_key, destination):
     try:
         wiki_params = {
             'action': 'query', 
@@ -150,142 +257,149 @@ def get_city_info(destination):
             'titles': destination,
             'prop': 'extracts', 
             'exintro': True, 
-            'explaintext': True
+            'explaintext': True,
+            # Cap the extract server-side; long articles have multi-KB intros
+            'exsentences': 5,
+            'exlimit': 1
         }
-        wiki_response = requests.get(
-            'https://en.wikipedia.org/w/api.php', 
+        wiki_response = SESSION.get(
+            WIKIPEDIA_URL, 
             params=wiki_params,
             timeout=10
         )
         wiki_response.raise_for_status()
         
         page = next(iter(wiki_response.json().get('query', {}).get('pages', {}).values()))
-        description = page.get('extract', 'No description available')
+        return page.get('extract', 'No description available')
+    except Exception as e:
+        logging.error("City description error: %s", e)
+        return CITY_DESCRIPTION_UNAVAILABLE
 
-        headers = {"Authorization": f"Client-ID {API_KEYS['UNSPLASH_API_KEY']}"}
-        unsplash_response = requests.get(
-            f'https://api.unsplash.com/search/photos?query={destination}&per_page=3',
-            headers=headers,
+@cache.memoize(timeout=86400, response_filter=bool, args_to_ignore=['destination'])
+def fetch_city_images(cache_key, destination):
+    try:
+        unsplash_response = SESSION.get(
+            UNSPLASH_URL,
+            params={'query': destination, 'per_page': 3},
+            headers=UNSPLASH_HEADERS,
             timeout=10
         )
         unsplash_response.raise_for_status()
         
-        images = [img['urls']['regular'] for img in unsplash_response.json().get('results', [])]
-
-        return {'description': description, 'images': images}
+        return [img['urls']['regular'] for img in unsplash_response.json().get('results', [])]
     except Exception as e:
-        logging.error(f"City info error: {str(e)}")
-        return {'description': 'Information unavailable', 'images': []}
+        logging.error("City images error: %s", e)
+        return []
 
-def optimize_routes(places, start_location):
+def optimize_routes(places, start_location, start_lat=None, start_lng=None):
     try:
         if not places or not start_location:
             return places
 
-        geocode_url = f"https://maps.googleapis.com/maps/api/geocode/json?address={start_location}&key={API_KEYS['GOOGLE_API_KEY']}"
-        geo_response = requests.get(geocode_url, timeout=10)
-        geo_response.raise_for_status()
-        geo_data = geo_response.json()
-        
-        if not geo_data.get('results'):
-            return places
-            
-        start_lat_lng = geo_data['results'][0]['geometry']['location']
-
-        places_with_coords = []
-        for place in places:
-            try:
-                geocode_url = f"https://maps.googleapis.com/maps/api/geocode/json?address={place['address']}&key={API_KEYS['GOOGLE_API_KEY']}"
-                geo_response = requests.get(geocode_url, timeout=10)
-                geo_response.raise_for_status()
-                geo_data = geo_response.json()
-                
-                if geo_data.get('results'):
-                    location = geo_data['results'][0]['geometry']['location']
-                    places_with_coords.append({
-                        **place,
-                        'lat': location['lat'],
-                        'lng': location['lng']
-                    })
-            except Exception as e:
-                logging.error(f"Geocoding error: {str(e)}")
-                continue
+        # Reuse coordinates the caller already resolved instead of geocoding again
+        if start_lat is not None and start_lng is not None:
+            start_lat_lng = {'lat': start_lat, 'lng': start_lng}
+        else:
+            start_lat_lng = geocode_place(start_location)
+            if not start_lat_lng:
+                return places
 
-        if not places_with_coords:
+        routable = [{**place} for place in places if place.get('address')]
+        if not routable:
             return places
 
-        directions_url = "https://maps.googleapis.com/maps/api/directions/json"
+        # With fewer than three stops every visiting order is equivalent,
+        # so skip the Directions round trip once every stop is on the map
+        if len(routable) < 3 and all('lat' in p and 'lng' in p for p in routable):
+            return routable
+
+        # Directions takes raw addresses as waypoints and reports where it
+        # resolved them, so stops without coordinates need no geocoding first
+        waypoints = [
+            f"{p['lat']},{p['lng']}" if 'lat' in p and 'lng' in p else p['address']
+            for p in routable
+        ]
         params = {
             'origin': f"{start_lat_lng['lat']},{start_lat_lng['lng']}",
             'destination': f"{start_lat_lng['lat']},{start_lat_lng['lng']}",
-            'waypoints': 'optimize:true|' + '|'.join([f"{p['lat']},{p['lng']}" for p in places_with_coords]),
+            'waypoints': 'optimize:true|' + '|'.join(waypoints),
             'key': API_KEYS['GOOGLE_API_KEY'],
             'mode': 'driving'
         }
         
-        response = requests.get(directions_url, params=params, timeout=15)
+        response = SESSION.get(DIRECTIONS_URL, params=params, timeout=15)
         response.raise_for_status()
         data = response.json()
 
         if data.get('status') == 'OK' and data.get('routes'):
             optimized_order = data['routes'][0]['waypoint_order']
-            optimized_places = [places_with_coords[i] for i in optimized_order]
+            optimized_places = [routable[i] for i in optimized_order]
             
+            # Leg i ends at the i-th stop of the optimized order
             legs = data['routes'][0]['legs']
-            for i in range(len(optimized_places)):
-                if i < len(legs):
-                    optimized_places[i]['travel_time'] = legs[i]['duration']['text']
-                    optimized_places[i]['travel_distance'] = legs[i]['distance']['text']
+            for place, leg in zip(optimized_places, legs):
+                place.setdefault('lat', leg['end_location']['lat'])
+                place.setdefault('lng', leg['end_location']['lng'])
+                place['travel_time'] = leg['duration']['text']
+                place['travel_distance'] = leg['distance']['text']
             
             return optimized_places
-        return places_with_coords
+        return [p for p in routable if 'lat' in p and 'lng' in p]
     except Exception as e:
-        logging.error(f"Routing error: {str(e)}")
+        logging.error("Routing error: %s", e)
         return places
 
+# Schedule times are minutes since midnight; slots are (ends before, label)
+DAY_START_MINUTES = 9 * 60
+ACTIVITY_MINUTES = 120
+TIME_SLOTS = (
+    (12 * 60, "Morning (9AM-12PM)"),
+    (17 * 60, "Afternoon (12PM-5PM)"),
+    (24 * 60, "Evening (5PM-9PM)")
+)
+
+def format_minutes(minutes):
+    return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+# Directions durations read like "25 mins" or "1 hour 5 mins"
+TRAVEL_TIME_RE = re.compile(r'(\d+)\s*(hour|min)')
+
+def parse_travel_minutes(travel_time):
+    minutes = sum(
+        int(amount) * (60 if unit == 'hour' else 1)
+        for amount, unit in TRAVEL_TIME_RE.findall(travel_time)
+    )
+    return minutes or 15
+
 def create_time_based_itinerary(places, travel_days):
     try:
         itinerary = {}
         max_activities_per_day = min(len(places) // travel_days + 1, 5)
         
-        day_chunks = [places[i:i + max_activities_per_day] 
-                     for i in range(0, len(places), max_activities_per_day)]
-        
         for day in range(1, travel_days + 1):
-            day_plan = {
-                "Morning (9AM-12PM)": [],
-                "Afternoon (12PM-5PM)": [],
-                "Evening (5PM-9PM)": []
-            }
-            current_time = datetime.strptime("09:00", "%H:%M")
-            activities_added = 0  # Reset for each day
-            daily_places = day_chunks[day-1] if (day-1) < len(day_chunks) else []
+            day_plan = {label: [] for _, label in TIME_SLOTS}
+            current_minutes = DAY_START_MINUTES
+            # Each day takes the next contiguous slice, so it never exceeds the cap
+            start = (day - 1) * max_activities_per_day
+            daily_places = places[start:start + max_activities_per_day]
             
-            for place in daily_places:  # Use daily_places instead of full list
-                if activities_added >= max_activities_per_day:
-                    break
-                
+            for place in daily_places:
                 if not all(key in place for key in ['name', 'address', 'lat', 'lng']):
                     continue
                 
                 try:
-                    activity_duration = timedelta(hours=2)
-                    end_time = current_time + activity_duration
+                    end_minutes = current_minutes + ACTIVITY_MINUTES
                     
                     # Determine time slot
-                    if current_time.hour < 12:
-                        slot = "Morning (9AM-12PM)"
-                    elif current_time.hour < 17:
-                        slot = "Afternoon (12PM-5PM)"
-                    else:
-                        slot = "Evening (5PM-9PM)"
+                    time_of_day = current_minutes % (24 * 60)
+                    slot = next(label for ends, label in TIME_SLOTS if time_of_day < ends)
                     
                     # Add activity
                     day_plan[slot].append({
                         "name": place['name'],
                         "address": place.get('address', 'Address not available'),
-                        "start_time": current_time.strftime("%H:%M"),
-                        "end_time": end_time.strftime("%H:%M"),
+                        "start_time": format_minutes(current_minutes),
+                        "end_time": format_minutes(end_minutes),
                         "travel_time": place.get('travel_time', '15 mins'),
                         "coordinates": {
                             "lat": place.get('lat', 0),
@@ -294,12 +408,9 @@ def create_time_based_itinerary(places, travel_days):
                     })
                     
                     # Update time
-                    travel_time_str = place.get('travel_time', '15 mins')
-                    travel_minutes = int(''.join(filter(str.isdigit, travel_time_str.split()[0])))
-                    current_time = end_time + timedelta(minutes=travel_minutes)
-                    activities_added += 1
+                    current_minutes = end_minutes + parse_travel_minutes(place.get('travel_time', '15 mins'))
                 except Exception as e:
-                    logging.error(f"Activity processing error: {str(e)}")
+                    logging.error("Activity processing error: %s", e)
                     continue
             
             itinerary[f"Day {day}"] = day_plan
@@ -307,19 +418,20 @@ def create_time_based_itinerary(places, travel_days):
         return itinerary  # Added missing return statement
         
     except Exception as e:
-        logging.error(f"Itinerary creation failed: {str(e)}")
+        logging.error("Itinerary creation failed: %s", e)
         return {f"Day {i+1}": {"Morning": [], "Afternoon": [], "Evening": []} for i in range(travel_days)}
 
+# Empty results mean the call failed or found nothing - don't cache those
+@cache.memoize(timeout=86400, response_filter=bool)
 def fetch_places(query, max_results=5):
     try:
-        places_url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
         params = {
             'query': f"{query}",
             'key': API_KEYS['GOOGLE_API_KEY'],
             'language': 'en',
             'region': 'PK'
         }
-        response = requests.get(places_url, params=params, timeout=10)
+        response = SESSION.get(PLACES_URL, params=params, timeout=10)
         response.raise_for_status()
         data = response.json()
         
@@ -332,37 +444,60 @@ def fetch_places(query, max_results=5):
             'name': p['name'],
             'address': p.get('formatted_address', 'Address not available'),
             'rating': p.get('rating', 5.0),
-            'price_level': p.get('price_level', random.randint(1, 4))
+            # Only simulate a price level when Google didn't return one
+            'price_level': p['price_level'] if 'price_level' in p else random.randint(1, 4),
+            # Text search already returns coordinates, so routing needn't geocode
+            **p.get('geometry', {}).get('location', {})
         } for p in results]
     except Exception as e:
-        logging.error(f"Places API error: {str(e)}")
+        logging.error("Places API error: %s", e)
         return []
 
+def fetch_activity_places(activities, destination, max_results=5):
+    # One Places text search per activity, issued concurrently
+    destination = normalize_destination(destination)
+    queries = [f"{activity} in {destination}" for activity in activities]
+    results = EXECUTOR.map(lambda query: fetch_places(query, max_results), queries)
+
+    # The same place often matches several activities - keep its first
+    # occurrence, and drop results that can't be routed without an address
+    unique_places = {}
+    for activity_places in results:
+        for place in activity_places:
+            address = place.get('address')
+            if address and address != 'Address not available' and address not in unique_places:
+                unique_places[address] = place
+    return list(unique_places.values())
+
 def fetch_weather(destination, days):
+    return fetch_daily_weather(destination, days, datetime.now(timezone.utc).date())
+
+# Keyed by the UTC date too, so an entry cached just before midnight never
+# serves yesterday's days; the forecast itself refreshes every 3 hours
+@cache.memoize(timeout=10800, response_filter=bool)
+def fetch_daily_weather(destination, days, today):
     try:
-        weather_url = "https://api.openweathermap.org/data/2.5/forecast"
         params = {
             'q': destination,
             'appid': API_KEYS['OPENWEATHER_API_KEY'],
             'units': 'metric'
         }
-        response = requests.get(weather_url, params=params, timeout=10)
+        response = SESSION.get(WEATHER_URL, params=params, timeout=10)
         response.raise_for_status()
         forecasts = response.json().get('list', [])
         
+        # Bucket the 3-hourly forecasts by UTC date in a single pass
+        forecasts_by_date = defaultdict(list)
+        for f in forecasts:
+            forecasts_by_date[datetime.fromtimestamp(f['dt'], tz=timezone.utc).date()].append(f)
+
         weather_data = []
         for i in range(days):
-            target_date = datetime.now(timezone.utc) + timedelta(days=i)
-            day_forecast = [
-                f for f in forecasts 
-                if datetime.fromtimestamp(f['dt'], tz=timezone.utc).date() == target_date.date()
-            ]
+            target_date = today + timedelta(days=i)
+            day_forecast = forecasts_by_date.get(target_date)
             
             if day_forecast:
-                try:
-                    avg_temp = sum(f['main']['temp'] for f in day_forecast) / len(day_forecast)
-                except ZeroDivisionError:
-                    avg_temp = 0
+                avg_temp = fmean(f['main']['temp'] for f in day_forecast)
                 
                 weather_data.append({
                     'date': target_date.strftime('%Y-%m-%d'),
@@ -372,30 +507,38 @@ def fetch_weather(destination, days):
                 })
         return weather_data
     except Exception as e:
-        logging.error(f"Weather API error: {str(e)}")
+        logging.error("Weather API error: %s", e)
         return []
 
 def create_ai_prompt(itinerary_data):
     try:
         # Create detailed daily breakdown
-        daily_plans = []
+        # Collect lines and join once rather than growing strings with +=;
+        # each day keeps its trailing newline, so days are blank-line separated
+        lines = []
         for day, schedule in itinerary_data['itinerary'].items():
-            day_plan = f"{day}:\n"
+            lines.append(f"{day}:")
             for time_slot, activities in schedule.items():
                 if activities:
-                    day_plan += f"- {time_slot}:\n"
-                    for activity in activities:
-                        day_plan += f"  • {activity['name']} ({activity.get('address', '')})\n"
-            daily_plans.append(day_plan)
+                    lines.append(f"- {time_slot}:")
+                    lines.extend(
+                        f"  • {activity['name']} ({activity.get('address', '')})"
+                        for activity in activities
+                    )
+            lines.append("")
+        schedule_text = "\n".join(lines)
+        weather_text = ', '.join(
+            f"{day['temp']}°C {day['description']}" for day in itinerary_data.get('weather', [])
+        )
 
         prompt = f"""Create a detailed {itinerary_data['travel_days']}-day travel itinerary for {itinerary_data['destination']} based on this schedule:
         
-        {'\n'.join(daily_plans)}
+        {schedule_text}
 
         Travel Group: {itinerary_data['companions']}
         Budget Level: {itinerary_data['budget']}
         Weather Forecast:
-        {', '.join([f"{day['temp']}°C {day['description']}" for day in itinerary_data.get('weather', [])])}
+        {weather_text}
 
         Enhance with:
         - Thematic daily summaries
@@ -410,9 +553,76 @@ def create_ai_prompt(itinerary_data):
         return prompt
     
     except Exception as e:
-        logging.error(f"Prompt creation error: {str(e)}")
+        logging.error("Prompt creation error: %s", e)
         return None
 
+# Prompts embed the full schedule and forecast, so an identical prompt
+# can reuse an earlier completion instead of calling OpenAI again
+@cache.memoize(timeout=7 * 86400, response_filter=bool)
+def fetch_ai_content(system_prompt, user_prompt):
+    response = client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.7,
+        max_tokens=1500
+    )
+    return response.choices[0].message.content
+
+def stream_ai_content(system_prompt, user_prompt):
+    # Same request as fetch_ai_content, but yields text as it is generated
+    stream = client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.7,
+        max_tokens=1500,
+        stream=True
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+# Markdown the model emits despite being asked not to
+BULLET_RE = re.compile(r'^[ \t]*[*-][ \t]+', re.MULTILINE)
+BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+ITALIC_RE = re.compile(r'\*(.+?)\*')
+
+def ai_content_to_html(text):
+    # The result is rendered with |safe, so escape the model output first
+    html = str(escape(text))
+    html = BULLET_RE.sub('• ', html)
+    html = BOLD_RE.sub(r'<strong>\1</strong>', html)
+    html = ITALIC_RE.sub(r'<em>\1</em>', html)
+    return html.replace('\n', '<br>')
+
+def run_in_native_thread(func, *args):
+    # Password KDFs are CPU-bound; running them on gevent's native thread pool
+    # lets the hub keep serving other requests while the hash is computed
+    return gevent.get_hub().threadpool.apply(func, args)
+
+PASSWORD_HASHER = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
+
+def verify_password(stored_hash, password):
+    # Accounts created before the switch to argon2 still carry Werkzeug hashes
+    if not stored_hash.startswith('$argon2'):
+        return check_password_hash(stored_hash, password)
+    try:
+        return PASSWORD_HASHER.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+# Fields the templates and /check-auth read; the password hash is never cached
+USER_FIELDS = {"name": 1, "email": 1, "created_at": 1}
+
+@cache.memoize(timeout=60)
+def load_user(user_id):
+    return users_collection.find_one({"_id": ObjectId(user_id)}, USER_FIELDS)
+
 
 
 @app.route('/')
@@ -420,13 +630,12 @@ def home():
     try:
         user = None
         if 'user_id' in session:
-            print("Session user_id:", session['user_id'])  # For debugging
-            user = users_collection.find_one({"_id": ObjectId(session['user_id'])})
-            print("User found:", bool(user))  # For debugging
+            user = load_user(session['user_id'])
+            app.logger.debug("home user_id=%s found=%s", session['user_id'], bool(user))
             
         return render_template('index.html', current_user=user)
-    except Exception as e:
-        print("Home route error:", str(e))
+    except Exception:
+        app.logger.exception("Home route error")
         return render_template('index.html', current_user=None)
 
 @app.route('/login')
@@ -443,7 +652,7 @@ def forum():
         return redirect(url_for('login'))
     return render_template('forum.html', 
         google_api_key=API_KEYS["GOOGLE_API_KEY"],
-        current_user=users_collection.find_one({"_id": ObjectId(session['user_id'])})
+        current_user=load_user(session['user_id'])
     )
 
 # User routes
@@ -461,10 +670,10 @@ def signup():
         if data['password'] != data['confirm_password']:
             return jsonify({"error": "Passwords do not match"}), 400
 
-        if users_collection.find_one({"email": data['email']}):
+        if users_collection.find_one({"email": data['email']}, {"_id": 1}):
             return jsonify({"error": "Email already exists"}), 409
 
-        hashed_pw = generate_password_hash(data['password'])
+        hashed_pw = run_in_native_thread(PASSWORD_HASHER.hash, data['password'])
         user = {
             "name": data['name'],
             "email": data['email'],
@@ -486,14 +695,26 @@ def signup():
 def login():
     try:
         data = request.get_json()
-        user = users_collection.find_one({"email": data['email']})
+        user = users_collection.find_one(
+            {"email": data['email']},
+            {"password": 1, "name": 1, "email": 1}
+        )
         
-        if not user or not check_password_hash(user['password'], data['password']):
+        if not user or not run_in_native_thread(verify_password, user['password'], data['password']):
             return jsonify({"error": "Invalid credentials"}), 401
-            
+
+        # Move legacy pbkdf2/scrypt hashes over to argon2 while the password is at hand
+        if not user['password'].startswith('$argon2'):
+            users_collection.update_one(
+                {"_id": user['_id']},
+                {"$set": {"password": run_in_native_thread(PASSWORD_HASHER.hash, data['password'])}}
+            )
 
         # Create session
         session['user_id'] = str(user['_id'])
+        # /check-auth answers from these without touching Mongo
+        session['user_name'] = user['name']
+        session['user_email'] = user['email']
         session.permanent = True
 
         return jsonify({
@@ -506,7 +727,8 @@ def login():
 
 @app.route('/logout')
 def logout():
-    session.pop('user_id', None)
+    for key in ('user_id', 'user_name', 'user_email'):
+        session.pop(key, None)
     return redirect(url_for('home'))
 
 # Add protected test route
@@ -520,12 +742,16 @@ def protected():
 @app.route('/check-auth')
 def check_auth():
     if 'user_id' in session:
-        user = users_collection.find_one({"_id": ObjectId(session['user_id'])})
+        if 'user_name' not in session:
+            # Sessions created before login started storing these fields
+            user = load_user(session['user_id'])
+            session['user_name'] = user['name']
+            session['user_email'] = user['email']
         return jsonify({
             "authenticated": True,
             "user": {
-                "name": user['name'],
-                "email": user['email']
+                "name": session['user_name'],
+                "email": session['user_email']
             }
         }), 200
     return jsonify({"authenticated": False}), 200
@@ -539,22 +765,36 @@ def debug_session():
 
 @app.route('/debug-cookies')
 def debug_cookies():
-    return jsonify({'cookies': request.cookies})
+    # orjson would serialize the MultiDict's internal lists, not its values
+    return jsonify({'cookies': request.cookies.to_dict()})
 
 
+PROFILE_PAGE_SIZE = 20
+
+# The list view never shows the schedule, places, weather or AI text
+PROFILE_ITINERARY_FIELDS = {
+    'destination': 1, 'travel_date': 1, 'travel_days': 1, 'created_at': 1,
+    'version': 1, 'is_current': 1, 'previous_versions': 1
+}
+
 @app.route('/profile')
 def profile():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    user = users_collection.find_one({"_id": ObjectId(session['user_id'])})
-    itineraries = itinerary_collection.find(
-        {"user_id": ObjectId(session['user_id'])}
-    ).sort('created_at', -1)
+    page = max(request.args.get('page', 1, type=int), 1)
+    user = load_user(session['user_id'])
+    # One extra document tells us whether there is a next page
+    itineraries = list(itinerary_collection.find(
+        {"user_id": ObjectId(session['user_id'])},
+        PROFILE_ITINERARY_FIELDS
+    ).sort('created_at', -1).skip((page - 1) * PROFILE_PAGE_SIZE).limit(PROFILE_PAGE_SIZE + 1))
     
     return render_template('profile.html', 
         user=user,
-        itineraries=itineraries
+        itineraries=itineraries[:PROFILE_PAGE_SIZE],
+        page=page,
+        has_next=len(itineraries) > PROFILE_PAGE_SIZE
     )
 
 @app.template_filter('datetimeformat')
@@ -567,6 +807,76 @@ def datetimeformat(value, format='%b %d, %Y'):
             return "Invalid date format"
     return value.strftime(format)
 
+# Compiled once at import; strict types match the old isinstance checks
+class GenerateRequest(BaseModel):
+    destination: StrictStr
+    travel_days: StrictInt
+    start_location: StrictStr
+    activities: list
+    travel_date: StrictStr
+    budget: StrictStr
+    companions: StrictStr
+
+# Incremental AI text; only meaningful live, the final ai_content phase
+# carries the whole text for replays and the merged JSON body
+STREAM_ONLY_PHASES = frozenset({'ai_delta'})
+
+def wants_ndjson():
+    return request.accept_mimetypes.best == 'application/x-ndjson'
+
+AI_CONTENT_MISSING = "Could not generate AI suggestions"
+AI_CONTENT_ERROR = "AI suggestions unavailable due to an error"
+
+def phase_failed(phase, payload):
+    # Same rule as the component caches' response_filters: a degraded
+    # result is still returned, but never replayed
+    if phase == 'weather':
+        return not payload['weather']
+    if phase == 'city_info':
+        city_info = payload['city_info']
+        return city_info['description'] == CITY_DESCRIPTION_UNAVAILABLE or not city_info['images']
+    if phase == 'ai_content':
+        return payload['ai_content'] in (AI_CONTENT_MISSING, AI_CONTENT_ERROR)
+    return False
+
+def record_phases(key, phases):
+    # Cache the full phase list only once every phase has been produced,
+    # and only if none of them fell back after an upstream failure
+    recorded = []
+    complete = True
+    for phase in phases:
+        if phase[0] not in STREAM_ONLY_PHASES:
+            recorded.append(phase)
+            complete = complete and not phase_failed(*phase)
+        yield phase
+    if complete:
+        # The replay cache is optional; a cache outage must not fail a
+        # response whose itinerary has already been saved
+        try:
+            cache.set(key, recorded, timeout=3600)
+        except Exception as e:
+            app.logger.warning("Response cache write failed: %s", e)
+
+def phases_response(phases):
+    # Clients that accept NDJSON get each phase as one line as it completes;
+    # everyone else gets the phases merged into a single JSON body
+    if wants_ndjson():
+        def stream():
+            try:
+                for phase, payload in phases:
+                    yield app.json.dumps({'phase': phase, **payload}) + '\n'
+            except Exception:
+                app.logger.exception("Unexpected error")
+                yield app.json.dumps({'phase': 'error', 'error': 'Internal server error'}) + '\n'
+
+        return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+
+    response_body = {}
+    for phase, payload in phases:
+        if phase not in STREAM_ONLY_PHASES:
+            response_body.update(payload)
+    return jsonify(response_body), 200
+
 @app.route('/generate', methods=['POST', 'OPTIONS'])
 @csrf.exempt
 @cross_origin(origins=["http://127.0.0.1:5500", "http://localhost:5500"],
@@ -575,185 +885,314 @@ def datetimeformat(value, format='%b %d, %Y'):
               supports_credentials=True)
 def generate_itinerary():
     try:
-        app.logger.info("Received request headers: %s", request.headers)
-        app.logger.info("Received request data: %s", request.get_data())
+        # get_data() copies the whole body, so only touch it when debugging
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug("Received request headers: %s", request.headers)
+            app.logger.debug("Received request data: %s", request.get_data())
         data = request.get_json()
 
-        required_fields = {
-            'destination': str,
-            'travel_days': int,
-            'start_location': str,
-            'activities': list,
-            'travel_date': str,
-            'budget': str,
-            'companions': str
-        }
-
-        missing_fields = [field for field in required_fields if field not in data]
-        if missing_fields:
-            return jsonify({
-                "error": "Missing required fields",
-                "missing": missing_fields
-            }), 400
-
-        type_errors = []
-        for field, expected_type in required_fields.items():
-            if not isinstance(data[field], expected_type):
-                type_errors.append({
-                    "field": field,
-                    "expected": expected_type.__name__,
-                    "actual": type(data[field]).__name__
-                })
-        
-        if type_errors:
+        try:
+            req = GenerateRequest.model_validate(data or {})
+        except ValidationError as e:
+            errors = e.errors()
+            missing_fields = ['.'.join(map(str, err['loc'])) for err in errors if err['type'] == 'missing']
+            if missing_fields:
+                return jsonify({
+                    "error": "Missing required fields",
+                    "missing": missing_fields
+                }), 400
             return jsonify({
                 "error": "Invalid data types",
-                "details": type_errors
+                "details": [
+                    {"field": '.'.join(map(str, err['loc'])), "message": err['msg']}
+                    for err in errors
+                ]
             }), 400
 
-        try:
-            travel_days = int(data['travel_days'])
-            if travel_days < 1 or travel_days > 14:
-                return jsonify({"error": "Travel days must be between 1-14"}), 400
-        except (ValueError, TypeError):
-            return jsonify({"error": "Invalid travel days format"}), 400
-
-        valid_activities = {'city', 'beaches', 'hiking', 'food'}
-        submitted_activities = [a for a in data['activities'] if a in valid_activities]
+        travel_days = req.travel_days
+        if travel_days < 1 or travel_days > 14:
+            return jsonify({"error": "Travel days must be between 1-14"}), 400
+
+        # Normalize and dedupe in submission order so a repeated activity
+        # doesn't trigger a second identical Places search
+        normalized = (a.strip().lower() for a in data['activities'] if isinstance(a, str))
+        submitted_activities = [a for a in dict.fromkeys(normalized) if a in VALID_ACTIVITIES]
         if not submitted_activities:
             return jsonify({"error": "No valid activities selected"}), 400
 
-        city_info = get_city_info(data['destination'])
-        if not city_info:
-            city_info = {'description': 'No description available', 'images': []}
+        # Identical submissions replay the previous result; the user is part
+        # of the key so a cached itinerary_id always belongs to the caller
+        canonical_request = {
+            'user_id': session['user_id'],
+            'destination': normalize_destination(data['destination']),
+            'start_location': ' '.join(data['start_location'].split()).lower(),
+            'travel_days': travel_days,
+            'travel_date': data['travel_date'],
+            'budget': data['budget'],
+            'companions': data['companions'],
+            'activities': sorted(submitted_activities)
+        }
+        response_key = 'itin:' + hashlib.blake2b(
+            orjson.dumps(canonical_request, option=orjson.OPT_SORT_KEYS)
+        ).hexdigest()
+        try:
+            cached_phases = cache.get(response_key)
+        except Exception as e:
+            app.logger.warning("Response cache read failed: %s", e)
+            cached_phases = None
+        # Replay only while the saved document is still the one this exact
+        # request produced: an /update supersedes it, and a regenerate of the
+        # same trip with other choices rewrites it in place
+        if cached_phases and itinerary_collection.count_documents({
+            '_id': ObjectId(cached_phases[-1][1]['itinerary_id']),
+            'is_current': True,
+            'request_key': response_key
+        }, limit=1):
+            return phases_response(cached_phases)
 
-        places = []
-        for activity in submitted_activities:
-            activity_places = fetch_places(f"{activity} in {data['destination']}")
-            if activity_places:
-                places.extend(activity_places)
+        # City info and weather don't depend on places - run them alongside
+        city_key = normalize_destination(data['destination'])
+        description_future = EXECUTOR.submit(fetch_city_description, city_key, data['destination'].strip())
+        images_future = EXECUTOR.submit(fetch_city_images, city_key, data['destination'].strip())
+        weather_future = EXECUTOR.submit(fetch_weather, normalize_destination(data['destination']), travel_days)
+        start_future = EXECUTOR.submit(geocode_place, data['start_location'])
+
+        places = fetch_activity_places(submitted_activities, data['destination'])
 
         if not places:
             return jsonify({"error": "No places found for selected activities"}), 404
 
-        optimized_places = optimize_routes(places, data['start_location']) or places
-        itinerary = create_time_based_itinerary(optimized_places, travel_days)
-        weather = fetch_weather(data['destination'], travel_days)
-
-        geocode_url = f"https://maps.googleapis.com/maps/api/geocode/json?address={data['start_location']}&key={API_KEYS['GOOGLE_API_KEY']}"
-        geo_response = requests.get(geocode_url, timeout=10)
-        geo_data = geo_response.json()
-        start_lat_lng = geo_data['results'][0]['geometry']['location'] if geo_data.get('results') else None
-
-        itinerary_data = {
-        
-                'destination': data['destination'],
-                'start_location': data['start_location'],
-                'travel_days': travel_days,
-                'travel_date': datetime.strptime(data['travel_date'], '%Y-%m-%d'),  # Parsed date
-                'start_lat': start_lat_lng['lat'] if start_lat_lng else None,
-                'start_lng': start_lat_lng['lng'] if start_lat_lng else None,
-                'budget': data['budget'],
-                'companions': data['companions'],
-                'activities': submitted_activities,
-                'city_info': city_info,
+        # Each phase is yielded as soon as it is ready so it can be streamed;
+        # the plain JSON response just merges them
+        streaming = wants_ndjson()
+        def build_phases():
+            # Start location is geocoded once and shared with route optimization
+            start_lat_lng = start_future.result()
+            optimized_places = optimize_routes(
+                places,
+                data['start_location'],
+                start_lat_lng['lat'] if start_lat_lng else None,
+                start_lat_lng['lng'] if start_lat_lng else None
+            ) or places
+            itinerary = create_time_based_itinerary(optimized_places, travel_days)
+            yield 'itinerary', {
                 'itinerary': itinerary,
-                'weather': weather,
-                'optimized_places': optimized_places,
-                'ai_content': "Could not generate AI suggestions",
-                'user_id': ObjectId(session['user_id']),
-                'created_at': datetime.now(timezone.utc),  # Single creation timestamp
-                'version': 1,
-                'previous_versions': [],
-                'is_current': True
-        }
- # AI Content Generation
-        try:
-            ai_prompt = create_ai_prompt(itinerary_data)
-            if ai_prompt:
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": "You are a professional travel planner. Create detailed, engaging itineraries."},
-                        {"role": "user", "content": ai_prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=1500
-                )
-                ai_content = response.choices[0].message.content
-                # Convert markdown-style formatting to HTML
-                ai_content = ai_content.replace('**', '<strong>').replace('**', '</strong>')
-                ai_content = ai_content.replace('*', '<em>').replace('*', '</em>')
-                ai_content = ai_content.replace('\n', '<br>')
-                itinerary_data['ai_content'] = ai_content
-        except Exception as e:
-            app.logger.error(f"AI Generation Error: {str(e)}")
-            itinerary_data['ai_content'] = "AI suggestions unavailable due to an error"
-            # Continue processing even if AI fails
+                'map_data': {
+                    'start_location': data['start_location'],
+                    'places': optimized_places
+                }
+            }
+
+            pending_city = {description_future, images_future}
+            for future in as_completed([weather_future, *pending_city]):
+                if future is weather_future:
+                    weather = future.result()
+                    yield 'weather', {'weather': weather}
+                    continue
+                pending_city.discard(future)
+                if not pending_city:
+                    city_info = {
+                        'description': description_future.result(),
+                        'images': images_future.result()
+                    }
+                    yield 'city_info', {'city_info': city_info}
+
+            itinerary_data = {
             
-        result = itinerary_collection.insert_one(itinerary_data)
-        itinerary_id = str(result.inserted_id)
-        users_collection.update_one(
-        {"_id": ObjectId(session['user_id'])},
-        {"$push": {"itineraries": itinerary_id}}
-         )
-        return jsonify({
-            'itinerary_id': itinerary_id,
-            'city_info': city_info,
-            'itinerary': itinerary,
-            'weather': weather,
-            'map_data': {
-                'start_location': data['start_location'],
-                'places': optimized_places
-            },
-            'ai_content': itinerary_data['ai_content']  # Include in response
-        }), 200
+                    'destination': data['destination'],
+                    'destination_key': normalize_destination(data['destination']),
+                    'start_location': data['start_location'],
+                    'travel_days': travel_days,
+                    'travel_date': datetime.strptime(data['travel_date'], '%Y-%m-%d'),  # Parsed date
+                    'start_lat': start_lat_lng['lat'] if start_lat_lng else None,
+                    'start_lng': start_lat_lng['lng'] if start_lat_lng else None,
+                    'budget': data['budget'],
+                    'companions': data['companions'],
+                    'activities': submitted_activities,
+                    'city_info': city_info,
+                    'itinerary': itinerary,
+                    'weather': weather,
+                    'optimized_places': optimized_places,
+                    'ai_content': AI_CONTENT_MISSING,
+                    'user_id': ObjectId(session['user_id']),
+                    'created_at': datetime.now(timezone.utc),  # Single creation timestamp
+                    'is_current': True,
+                    'request_key': response_key  # Ties the document to its replay entry
+            }
+            # AI generation and the save run on the executor and hand their
+            # phases back through a queue, so the itinerary is still saved
+            # when the client disconnects mid-stream
+            phase_queue = queue.Queue()
+
+            def finish_itinerary():
+                try:
+                    # AI Content Generation
+                    try:
+                        ai_prompt = create_ai_prompt(itinerary_data)
+                        if ai_prompt:
+                            system_prompt = "You are a professional travel planner. Create detailed, engaging itineraries."
+                            if streaming:
+                                # Forward the text as it arrives instead of holding
+                                # the stream open in silence for the whole completion
+                                chunks = []
+                                for delta in stream_ai_content(system_prompt, ai_prompt):
+                                    chunks.append(delta)
+                                    phase_queue.put(('ai_delta', {'delta': delta}))
+                                ai_content = ''.join(chunks)
+                            else:
+                                ai_content = fetch_ai_content(system_prompt, ai_prompt)
+                            itinerary_data['ai_content'] = ai_content_to_html(ai_content)
+                    except Exception as e:
+                        app.logger.error("AI Generation Error: %s", e)
+                        itinerary_data['ai_content'] = AI_CONTENT_ERROR
+                        # Continue processing even if AI fails
+                    phase_queue.put(('ai_content', {'ai_content': itinerary_data['ai_content']}))
+
+                    # Regenerating the same trip refreshes the current plan in place
+                    # instead of piling up another document for it. The result is a
+                    # fresh plan, so edit history from /update no longer applies.
+                    trip_filter = {
+                        'user_id': itinerary_data['user_id'],
+                        'destination_key': itinerary_data['destination_key'],
+                        'travel_date': itinerary_data['travel_date'],
+                        'is_current': True
+                    }
+                    for attempt in range(2):
+                        try:
+                            saved = itinerary_writes.find_one_and_update(
+                                trip_filter,
+                                {
+                                    '$set': {**itinerary_data, 'version': 1, 'previous_versions': []},
+                                    '$unset': {'modification_history': ''}
+                                },
+                                projection={'_id': 1},
+                                upsert=True,
+                                return_document=pymongo.ReturnDocument.AFTER
+                            )
+                            break
+                        except DuplicateKeyError:
+                            # A concurrent submit of the same trip inserted first;
+                            # the retry matches its document and updates it
+                            if attempt:
+                                raise
+                    itinerary_id = str(saved['_id'])
+                    phase_queue.put(('done', {'itinerary_id': itinerary_id}))
+                except Exception:
+                    # Nobody may be waiting on the result any more
+                    app.logger.exception("Saving itinerary failed")
+                    raise
+                finally:
+                    phase_queue.put(None)
+
+            finished = EXECUTOR.submit(finish_itinerary)
+            while (phase := phase_queue.get()) is not None:
+                yield phase
+            # Re-raise a failed save into the stream's error handling
+            finished.result()
+
+        return phases_response(record_phases(response_key, build_phases()))
 
 
     except Exception as e:
-        app.logger.error(f"Unexpected error: {traceback.format_exc()}")
+        app.logger.exception("Unexpected error")
         return jsonify({
             "error": "Internal server error",
             "message": str(e)
         }), 500
 
 
+# Fields results.html renders, plus created_at for the ETag; version
+# history and ownership data stay in Mongo
+ITINERARY_VIEW_FIELDS = {
+    field: 1 for field in (
+        'destination', 'start_location', 'travel_date', 'travel_days', 'budget',
+        'companions', 'activities', 'city_info', 'itinerary', 'weather',
+        'optimized_places', 'ai_content', 'created_at'
+    )
+}
+
+def results_page_version():
+    # Everything the page depends on besides the itinerary and the session:
+    # the template source, the deploy (BUILD_ID) and the Maps key it embeds
+    with open(os.path.join(app.root_path, app.template_folder, 'results.html'), 'rb') as f:
+        digest = hashlib.blake2b(f.read(), digest_size=16)
+    digest.update(f"{os.getenv('BUILD_ID', '')}:{API_KEYS['GOOGLE_API_KEY']}".encode())
+    return digest.hexdigest()
+
+RESULTS_PAGE_VERSION = results_page_version()
+
+def itinerary_etag(itinerary_id, created_at):
+    # Regenerating a trip rewrites created_at in place, so together with the
+    # id it identifies the itinerary the page shows. The embedded CSRF token
+    # is tied to the session and expires, so the tag also changes with the
+    # session's token and with each token lifetime; a page revalidated
+    # within one window still carries a valid token.
+    token_window = int(datetime.now(timezone.utc).timestamp()) // app.config['WTF_CSRF_TIME_LIMIT']
+    return hashlib.blake2b(
+        f"{RESULTS_PAGE_VERSION}:{itinerary_id}:{created_at}:"
+        f"{session.get('csrf_token')}:{token_window}".encode(),
+        digest_size=16
+    ).hexdigest()
+
+def not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/itinerary/<itinerary_id>')
 def view_itinerary(itinerary_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
-    
-    itinerary = itinerary_collection.find_one({
-        "_id": ObjectId(itinerary_id),
-        "user_id": ObjectId(session['user_id'])
-    })
-    
-    if not itinerary:
-        return render_template('error.html', error="Itinerary not found"), 404
+
+    if not ObjectId.is_valid(itinerary_id):
+        return render_template('error.html', error="Invalid itinerary ID"), 400
+
     try:
-        if not ObjectId.is_valid(itinerary_id):
-            return render_template('error.html', error="Invalid itinerary ID"), 400
-            
-        obj_id = ObjectId(itinerary_id)
-        itinerary = itinerary_collection.find_one({"_id": obj_id})
+        owner_filter = {
+            "_id": ObjectId(itinerary_id),
+            "user_id": ObjectId(session['user_id'])
+        }
+        # A revalidating browser usually gets a 304, which only needs
+        # created_at; everyone else gets the page from a single query
+        if request.if_none_match:
+            stamp = itinerary_collection.find_one(owner_filter, {"created_at": 1})
+            if not stamp:
+                return render_template('error.html', error="Itinerary not found"), 404
+            etag = itinerary_etag(itinerary_id, stamp.get('created_at'))
+            if etag in request.if_none_match:
+                return not_modified(etag)
+
+        itinerary = itinerary_collection.find_one(owner_filter, ITINERARY_VIEW_FIELDS)
         
         if not itinerary:
             return render_template('error.html', error="Itinerary not found"), 404
+
+        generated_at = itinerary.pop('created_at', None)
+        etag = itinerary_etag(itinerary_id, generated_at)
             
-        itinerary = convert_bson_types(itinerary)
+        # Only the top-level _id and travel_date are BSON types; places,
+        # weather and city info are stored API payloads, so there is no
+        # need to walk them
+        itinerary['_id'] = str(itinerary['_id'])
+        if isinstance(itinerary.get('travel_date'), datetime):
+            itinerary['travel_date'] = itinerary['travel_date'].isoformat()
         
         required_fields = ['destination', 'start_location', 'itinerary']
         for field in required_fields:
             if field not in itinerary:
                 return render_template('error.html', error=f"Missing {field} in itinerary"), 400
 
-        return render_template('results.html', 
+        response = make_response(render_template('results.html', 
                             itinerary=itinerary,
                             google_api_key=API_KEYS['GOOGLE_API_KEY'],
-                            now=datetime.now(timezone.utc))
+                            generated_at=generated_at))
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
                             
-    except Exception as e:
-        logging.error(f"Itinerary Error: {traceback.format_exc()}")
+    except Exception:
+        logging.exception("Itinerary Error")
         return render_template('error.html', error="Server error"), 500
 
 @app.route('/itinerary/<itinerary_id>/update', methods=['POST'])
@@ -792,6 +1231,7 @@ def update_itinerary(itinerary_id):
             }],
             # Core itinerary data
             'destination': original['destination'],
+            'destination_key': normalize_destination(original['destination']),
             'start_location': original['start_location'],
             'start_lat': original.get('start_lat'),
             'start_lng': original.get('start_lng'),
@@ -824,32 +1264,20 @@ def update_itinerary(itinerary_id):
 
             # Handle new activities
             if 'new_activities' in modifications:
-                valid_activities = {'city', 'beaches', 'hiking', 'food'}
                 new_activities = [
                     a for a in modifications['new_activities']
-                    if a in valid_activities and a not in new_itinerary['activities']
+                    if a in VALID_ACTIVITIES and a not in new_itinerary['activities']
                 ]
                 new_itinerary = handle_new_activities(new_itinerary, new_activities)
 
         except ValueError as e:
             return jsonify({"error": str(e)}), 400
 
-        # Geocode new places and optimize routes
+        # Re-optimize routes, resolving coordinates for new places
         try:
-            # Ensure all places have coordinates
-            optimized_places = []
-            for place in new_itinerary['optimized_places']:
-                if 'lat' not in place or 'lng' not in place:
-                    geocoded = geocode_place(place['address'])
-                    if geocoded:
-                        place.update(geocoded)
-                        optimized_places.append(place)
-                else:
-                    optimized_places.append(place)
-            
-            # Re-optimize with proper coordinates
+            # Stops without coordinates are resolved by the Directions call
             optimized_places = optimize_routes(
-                optimized_places,
+                new_itinerary['optimized_places'],
                 new_itinerary['start_location'],
                 new_itinerary.get('start_lat'),
                 new_itinerary.get('start_lng')
@@ -857,7 +1285,7 @@ def update_itinerary(itinerary_id):
             new_itinerary['optimized_places'] = optimized_places
 
         except Exception as e:
-            app.logger.error(f"Routing error: {str(e)}")
+            app.logger.error("Routing error: %s", e)
             return jsonify({"error": "Failed to optimize routes"}), 500
 
         # Regenerate time-based schedule
@@ -867,57 +1295,47 @@ def update_itinerary(itinerary_id):
                 new_itinerary['travel_days']
             )
         except Exception as e:
-            app.logger.error(f"Scheduling error: {str(e)}")
+            app.logger.error("Scheduling error: %s", e)
             return jsonify({"error": "Failed to generate schedule"}), 500
 
         # Regenerate AI content with proper error handling
         try:
             ai_prompt = create_ai_prompt(new_itinerary)
             if ai_prompt:
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[{
-                        "role": "system",
-                        "content": "Generate a professional travel itinerary with time slots, locations, and practical advice."
-                    }, {
-                        "role": "user",
-                        "content": ai_prompt
-                    }],
-                    temperature=0.7,
-                    max_tokens=1500
+                ai_content = fetch_ai_content(
+                    "Generate a professional travel itinerary with time slots, locations, and practical advice.",
+                    ai_prompt
                 )
-                ai_content = response.choices[0].message.content
-                # Safe HTML conversion
-                ai_content = ai_content.replace('\n', '<br>') \
-                                       .replace('**', '<strong>') \
-                                       .replace('**', '</strong>') \
-                                       .replace('*', '• ')
-                new_itinerary['ai_content'] = ai_content
+                new_itinerary['ai_content'] = ai_content_to_html(ai_content)
         except Exception as e:
-            app.logger.error(f"AI generation failed: {str(e)}")
+            app.logger.error("AI generation failed: %s", e)
             new_itinerary['ai_content'] = "AI suggestions currently unavailable"
 
         # Database operations
         try:
-            # Insert new version
-            result = itinerary_collection.insert_one(new_itinerary)
-            # Mark old version as inactive
-            itinerary_collection.update_one(
-                {'_id': original['_id']},
-                {'$set': {'is_current': False}}
-            )
+            # Mark the old version inactive and insert the new one in one round
+            # trip; the old one goes first since only one version of a trip
+            # may be current at a time
+            new_itinerary['_id'] = ObjectId()
+            itinerary_collection.bulk_write([
+                pymongo.UpdateOne(
+                    {'_id': original['_id']},
+                    {'$set': {'is_current': False}}
+                ),
+                pymongo.InsertOne(new_itinerary)
+            ])
         except Exception as e:
-            app.logger.error(f"Database error: {str(e)}")
+            app.logger.error("Database error: %s", e)
             return jsonify({"error": "Failed to save itinerary"}), 500
 
         return jsonify({
-            'new_itinerary_id': str(result.inserted_id),
+            'new_itinerary_id': str(new_itinerary['_id']),
             'version': new_itinerary['version'],
             'message': 'Itinerary updated successfully'
         }), 200
 
-    except Exception as e:
-        app.logger.error(f"Update failed: {traceback.format_exc()}")
+    except Exception:
+        app.logger.exception("Update failed")
         return jsonify({
             "error": "Internal server error",
             "message": "Please try again later"
@@ -926,12 +1344,11 @@ def update_itinerary(itinerary_id):
 # Helper function for geocoding
 def geocode_place(address):
     try:
-        geocode_url = f"https://maps.googleapis.com/maps/api/geocode/json"
         params = {
             'address': address,
             'key': API_KEYS['GOOGLE_API_KEY']
         }
-        response = requests.get(geocode_url, params=params, timeout=10)
+        response = SESSION.get(GEOCODE_URL, params=params, timeout=10)
         response.raise_for_status()
         results = response.json().get('results', [])
         if results:
@@ -942,7 +1359,7 @@ def geocode_place(address):
             }
         return None
     except Exception as e:
-        app.logger.warning(f"Geocoding failed for {address}: {str(e)}")
+        app.logger.warning("Geocoding failed for %s: %s", address, e)
         return None
 
 
@@ -951,13 +1368,10 @@ def handle_duration_change(itinerary, new_days):
     if new_days > old_days:
         # Calculate how many new places we need (3 per extra day)
         additional_needed = (new_days - old_days) * 3
-        new_places = []
         
         # Get new places for existing activities
-        for activity in itinerary['activities']:
-            places = fetch_places(f"{activity} in {itinerary['destination']}", 
-                                max_results=additional_needed)
-            new_places.extend(places)
+        new_places = fetch_activity_places(itinerary['activities'], itinerary['destination'],
+                                           max_results=additional_needed)
         
         # Add unique new places
         unique_new = [p for p in new_places if p not in itinerary['optimized_places']]
@@ -972,29 +1386,37 @@ def handle_duration_change(itinerary, new_days):
 
 
 def handle_location_replacements(itinerary, replacements):
+    pending = []
     for replacement in replacements:
         old_place = next((p for p in itinerary['optimized_places'] if p['name'] == replacement['old']), None)
         if old_place:
-            new_places = fetch_places(f"{replacement['type']} in {itinerary['destination']}")
-            if new_places:
-                itinerary['optimized_places'].remove(old_place)
-                itinerary['optimized_places'].append(new_places[0])
+            pending.append((old_place, replacement['type']))
+
+    # Look up all replacement candidates in one concurrent batch
+    results = EXECUTOR.map(
+        lambda item: fetch_places(f"{item[1]} in {itinerary['destination']}"),
+        pending
+    )
+    for (old_place, _), new_places in zip(pending, results):
+        if new_places and old_place in itinerary['optimized_places']:
+            itinerary['optimized_places'].remove(old_place)
+            itinerary['optimized_places'].append(new_places[0])
     return itinerary
 
 
 def handle_new_activities(itinerary, new_activities):
-    for activity in new_activities:
-        if activity not in itinerary['activities']:
-            new_places = fetch_places(f"{activity} in {itinerary['destination']}")
-            itinerary['optimized_places'].extend(new_places)
-            itinerary['activities'].append(activity)
+    new_activities = [a for a in dict.fromkeys(new_activities) if a not in itinerary['activities']]
+    if new_activities:
+        new_places = fetch_activity_places(new_activities, itinerary['destination'])
+        itinerary['optimized_places'].extend(new_places)
+        itinerary['activities'].extend(new_activities)
     return itinerary
 
 @app.route('/test_db')
 def test_db():
     try:
         mongo.cx.admin.command('ping')
-        count = itinerary_collection.count_documents({})
+        count = itinerary_collection.estimated_document_count()
         return jsonify({
             "status": "connected",
             "itinerary_count": count
@@ -1044,6 +1466,7 @@ def internal_error(error):
 
 
 
+# Development server only - production runs under gunicorn (see wsgi.py)
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_ENV') == 'development')
 
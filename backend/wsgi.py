@@ -0,0 +1,2 @@
+# gunicorn -k gevent -w 4 --worker-connections 1000 -b 0.0.0.0:5000 wsgi:app
+from app import app